@@ -1,13 +1,57 @@
+import math
 import random
+from functools import partial
 
 import torch
 import torch.nn.functional as F
 
 
 def random_hflip(tensor, prob):
-    if prob > random():
+    """flip each image horizontally with probability `prob`"""
+    flip = torch.rand(tensor.size(0), 1, 1, 1, device=tensor.device) < prob
+    return torch.where(flip, torch.flip(tensor, dims=(3,)), tensor)
+
+
+def random_resized_crop(tensor, prob, scale=(0.5, 1.0), ratio=(0.98, 1.02)):
+    """crop a random area and aspect ratio out of each image with probability
+    `prob`, resized back to the original size, in one batched grid sample"""
+    if prob <= 0:
         return tensor
-    return torch.flip(tensor, dims=(3,))
+
+    batch, device = tensor.size(0), tensor.device
+    rand = partial(torch.rand, batch, device=device)
+
+    area = rand() * (scale[1] - scale[0]) + scale[0]
+    log_ratio = rand() * (math.log(ratio[1]) - math.log(ratio[0])) + math.log(ratio[0])
+    aspect = torch.exp(log_ratio)
+
+    width = torch.sqrt(area * aspect).clamp(max=1.0)
+    height = torch.sqrt(area / aspect).clamp(max=1.0)
+
+    # normalized crop centers, kept inside the image
+    center_x = (rand() * 2 - 1) * (1 - width)
+    center_y = (rand() * 2 - 1) * (1 - height)
+
+    # samples that are not augmented get the identity transform
+    apply = rand() < prob
+    width = torch.where(apply, width, torch.ones_like(width))
+    height = torch.where(apply, height, torch.ones_like(height))
+    center_x = torch.where(apply, center_x, torch.zeros_like(center_x))
+    center_y = torch.where(apply, center_y, torch.zeros_like(center_y))
+
+    zeros = torch.zeros_like(width)
+    theta = torch.stack(
+        (
+            torch.stack((width, zeros, center_x), dim=-1),
+            torch.stack((zeros, height, center_y), dim=-1),
+        ),
+        dim=1,
+    ).to(tensor.dtype)
+
+    grid = F.affine_grid(theta, tensor.shape, align_corners=False)
+    return F.grid_sample(
+        tensor, grid, mode="bilinear", padding_mode="border", align_corners=False
+    )
 
 
 # """
@@ -41,7 +85,9 @@ def rand_contrast(x):
     return x
 
 
-def rand_translation(x, ratio=0.125):
+def translation_indices(x, ratio=0.125):
+    """flat indices into the zero padded image for a random shift of each image,
+    index 0 always points at a zero in the padding"""
     shift_x, shift_y = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
     translation_x = torch.randint(
         -shift_x, shift_x + 1, size=[x.size(0), 1, 1], device=x.device
@@ -49,21 +95,25 @@ def rand_translation(x, ratio=0.125):
     translation_y = torch.randint(
         -shift_y, shift_y + 1, size=[x.size(0), 1, 1], device=x.device
     )
-    grid_batch, grid_x, grid_y = torch.meshgrid(
-        torch.arange(x.size(0), dtype=torch.long, device=x.device),
+    grid_x, grid_y = torch.meshgrid(
         torch.arange(x.size(2), dtype=torch.long, device=x.device),
         torch.arange(x.size(3), dtype=torch.long, device=x.device),
         indexing="ij",
     )
     grid_x = torch.clamp(grid_x + translation_x + 1, 0, x.size(2) + 1)
     grid_y = torch.clamp(grid_y + translation_y + 1, 0, x.size(3) + 1)
-    x_pad = F.pad(x, [1, 1, 1, 1, 0, 0, 0, 0])
-    x = (
-        x_pad.permute(0, 2, 3, 1)
-        .contiguous()[grid_batch, grid_x, grid_y]
-        .permute(0, 3, 1, 2)
-    )
-    return x
+    return (grid_x * (x.size(3) + 2) + grid_y).flatten(1)
+
+
+def gather_padded(x, indices):
+    """gather pixels of the zero padded image straight into a contiguous tensor"""
+    x_pad = F.pad(x, [1, 1, 1, 1]).flatten(2)
+    indices = indices.unsqueeze(1).expand(-1, x.size(1), -1)
+    return x_pad.gather(2, indices).view_as(x)
+
+
+def rand_translation(x, ratio=0.125):
+    return gather_padded(x, translation_indices(x, ratio))
 
 
 def rand_offset(x, ratio=1, ratio_h=1, ratio_v=1):
@@ -96,7 +146,7 @@ def rand_offset_v(x, ratio=1):
     return rand_offset(x, ratio=1, ratio_h=0, ratio_v=ratio)
 
 
-def rand_cutout(x, ratio=0.5):
+def cutout_mask(x, ratio=0.5):
     cutout_size = int(x.size(2) * ratio + 0.5), int(x.size(3) * ratio + 0.5)
     offset_x = torch.randint(
         0, x.size(2) + (1 - cutout_size[0] % 2), size=[x.size(0), 1, 1], device=x.device
@@ -118,8 +168,28 @@ def rand_cutout(x, ratio=0.5):
     )
     mask = torch.ones(x.size(0), x.size(2), x.size(3), dtype=x.dtype, device=x.device)
     mask[grid_batch, grid_x, grid_y] = 0
-    x = x * mask.unsqueeze(1)
-    return x
+    return mask
+
+
+def rand_cutout(x, ratio=0.5):
+    return x * cutout_mask(x, ratio).unsqueeze(1)
+
+
+# fused augmentations, the cutout is folded into the translation gather by
+# pointing cut out pixels at the zero padding, so the image is only read once
+
+
+def rand_translation_cutout(x):
+    indices = translation_indices(x)
+    cut = cutout_mask(x).flatten(1) == 0
+    return gather_padded(x, indices.masked_fill(cut, 0))
+
+
+def rand_cutout_translation(x):
+    mask = cutout_mask(x)
+    indices = translation_indices(x)
+    cut = F.pad(mask, [1, 1, 1, 1]).flatten(1).gather(1, indices) == 0
+    return gather_padded(x, indices.masked_fill(cut, 0))
 
 
 AUGMENT_FNS = {
@@ -130,3 +200,8 @@ AUGMENT_FNS = {
     "translation": [rand_translation],
     "cutout": [rand_cutout],
 }
+
+FUSED_AUGMENT_FNS = {
+    ("translation", "cutout"): [rand_translation_cutout],
+    ("cutout", "translation"): [rand_cutout_translation],
+}
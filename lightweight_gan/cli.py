@@ -4,13 +4,21 @@ import fire
 import torch
 import torch.distributed as dist
 import torch.multiprocessing as mp
-from retry.api import retry_call
 from tqdm import tqdm
 
+from lightweight_gan.dataset import CachedImageDataset
 from lightweight_gan.diff_augment_test import DiffAugmentTest
 from lightweight_gan.exceptions import NanException
 from lightweight_gan.trainer import Trainer
-from lightweight_gan.utils import cast_list, current_iso_datetime, default, set_seed
+from lightweight_gan.utils import (
+    cast_list,
+    current_iso_datetime,
+    default,
+    exists,
+    set_seed,
+)
+
+NAN_RETRIES = 3
 
 
 def run_training(
@@ -23,6 +31,7 @@ def run_training(
     num_train_steps,
     name,
     seed,
+    deterministic,
     use_aim,
     aim_repo,
     aim_run_hash,
@@ -39,6 +48,7 @@ def run_training(
         num_train_steps: int, number of training steps
         name: str, name of training
         seed: int, seed for random number generator
+        deterministic: bool, whether to use deterministic cudnn kernels
         use_aim: bool, whether to use AIM
         aim_repo: str, path to AIM repository
         aim_run_hash: str, hash of AIM run
@@ -50,10 +60,12 @@ def run_training(
     is_main = rank == 0
     is_ddp = world_size > 1
 
+    set_seed(seed, deterministic=deterministic)
+
     if is_ddp:
-        set_seed(seed)
         os.environ["MASTER_ADDR"] = "localhost"
         os.environ["MASTER_PORT"] = "12355"
+        torch.cuda.set_device(rank)
         dist.init_process_group("nccl", rank=rank, world_size=world_size)
 
         print(f"{rank + 1}/{world_size} process initialized.")
@@ -82,7 +94,14 @@ def run_training(
         desc=f"{name}<{data}>",
     )
     while model.steps < num_train_steps:
-        retry_call(model.train, tries=3, exceptions=NanException)
+        for attempt in range(NAN_RETRIES):
+            try:
+                model.train()
+                break
+            except NanException:
+                if attempt == NAN_RETRIES - 1:
+                    raise
+                model.backoff_loss_scale()
         progress_bar.n = model.steps
         progress_bar.refresh()
         if is_main and model.steps % 50 == 0:
@@ -134,12 +153,17 @@ def train_from_folder(
     calculate_fid_num_images=12800,
     clear_fid_cache=False,
     seed=42,
+    deterministic=False,
     amp=False,
     show_progress=False,
     use_aim=False,
     aim_repo=None,
     aim_run_hash=None,
     load_strict=True,
+    pin_memory=True,
+    cache_dataset=False,
+    channels_last=False,
+    cuda_graph=False,
 ):
     """available commands:
         generate - generate images
@@ -175,6 +199,7 @@ def train_from_folder(
         load_from: int, load model from this checkpoint
         num_train_steps: int, number of training steps
         seed: int, seed for random number generator
+        deterministic: bool, whether to use deterministic cudnn kernels
         use_aim: bool, whether to use AIM
         aim_repo: str, path to AIM repository
         aim_run_hash: str, hash of AIM run
@@ -208,6 +233,10 @@ def train_from_folder(
         clear_fid_cache: bool, whether to clear fid cache
         amp: bool, whether to use amp
         load_strict: bool, whether to load strict
+        pin_memory: bool, whether to pin memory of batches for async transfer to gpu
+        cache_dataset: bool, whether to cache decoded images in a memory-mapped file
+        channels_last: bool, whether to use channels last memory format for rgb images
+        cuda_graph: bool, whether to replay cuda graphs when generating (torch>=2.0)
 
     Returns:
         None
@@ -215,6 +244,11 @@ def train_from_folder(
 
     num_image_tiles = default(num_image_tiles, 4 if image_size > 512 else 8)
 
+    if exists(num_workers) and num_workers > 8:
+        print(
+            f"{num_workers} dataloader workers per process will likely be slower than 4 to 8, due to contention"
+        )
+
     model_args = dict(
         name=name,
         results_dir=results_dir,
@@ -244,6 +278,10 @@ def train_from_folder(
         clear_fid_cache=clear_fid_cache,
         amp=amp,
         load_strict=load_strict,
+        pin_memory=pin_memory,
+        cache_dataset=cache_dataset,
+        channels_last=channels_last,
+        cuda_graph=cuda_graph,
     )
 
     if generate:
@@ -289,6 +327,13 @@ def train_from_folder(
         assert (
             torch.cuda.is_available()
         ), "You need to have an Nvidia GPU with CUDA installed."
+
+        # build the cache once up front, rather than in every spawned rank
+        if cache_dataset:
+            CachedImageDataset(
+                data, image_size, transparent=transparent, greyscale=greyscale
+            )
+
         world_size = torch.cuda.device_count()
 
         if world_size == 1 or not multi_gpus:
@@ -302,6 +347,7 @@ def train_from_folder(
                 num_train_steps,
                 name,
                 seed,
+                deterministic,
                 use_aim,
                 aim_repo,
                 aim_run_hash,
@@ -318,6 +364,7 @@ def train_from_folder(
                     num_train_steps,
                     name,
                     seed,
+                    deterministic,
                     use_aim,
                     aim_repo,
                     aim_run_hash,
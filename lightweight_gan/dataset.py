@@ -1,18 +1,33 @@
-from functools import partial
+import hashlib
+import os
+import pickle
+from functools import lru_cache, partial
 from pathlib import Path
-from random import random
 
+import numpy as np
+import PIL
 import torch
 import torchvision
 from PIL import Image
 from torch.utils.data import Dataset
 from torchvision import transforms
+from torchvision.transforms import InterpolationMode
 
 from lightweight_gan.utils import exists
 
 EXTS = ["jpg", "jpeg", "png"]
 
+# path index and decoded image caches are kept out of the data folder, since
+# writing there would change its mtime and invalidate the path index
+INDEX_DIR = Path.home() / ".cache" / "lightweight_gan"
+
+
 # dataset
+def pil_backend():
+    """pillow-simd tags its releases with a `.postN` suffix"""
+    return "pillow-simd" if "post" in PIL.__version__ else "pillow"
+
+
 def convert_image_to(img_type, image):
     if image.mode != img_type:
         return image.convert(img_type)
@@ -23,6 +38,12 @@ def identity(tensor):
     return tensor
 
 
+@lru_cache(maxsize=8)
+def opaque_alpha(height, width, dtype, device):
+    """shared alpha channel, reused across samples of the same size"""
+    return torch.ones(1, height, width, dtype=dtype, device=device)
+
+
 def expand_greyscale(tensor, transparent):
     channels = tensor.shape[0]
     num_target_channels = 4 if transparent else 3
@@ -39,31 +60,85 @@ def expand_greyscale(tensor, transparent):
     else:
         raise Exception(f"image with invalid number of channels given {channels}")
 
-    if not exists(alpha) and transparent:
-        alpha = torch.ones(1, *tensor.shape[1:], device=tensor.device)
+    if not transparent:
+        return color.contiguous()
 
-    return color if not transparent else torch.cat((color, alpha))
+    if not exists(alpha):
+        alpha = opaque_alpha(*tensor.shape[1:], tensor.dtype, tensor.device)
+
+    return torch.cat((color, alpha))
 
 
 def resize_to_minimum_size(min_size, image):
     if max(*image.size) < min_size:
-        return torchvision.transforms.functional.resize(image, min_size)
+        return torchvision.transforms.functional.resize(
+            image, min_size, interpolation=InterpolationMode.BILINEAR
+        )
     return image
 
 
-def random_apply(prob, fn1, fn2):
-    """randomly apply one of two functions"""
-    return fn1 if random() < prob else fn2
+def scan_folder(folder):
+    """walk the folder once with os.scandir, returns the sorted image paths and
+    the mtime of every directory visited"""
+    exts = tuple(f".{ext}" for ext in EXTS)
+    paths, dir_mtimes = [], {}
+    stack = [str(folder)]
+
+    while stack:
+        directory = stack.pop()
+        dir_mtimes[directory] = os.stat(directory).st_mtime_ns
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(exts):
+                    paths.append(entry.path)
+
+    return sorted(paths), dir_mtimes
+
+
+def folder_cache_path(folder, suffix):
+    """path under INDEX_DIR, keyed by the absolute path of the data folder"""
+    folder_hash = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()
+    return INDEX_DIR / f"{folder_hash}{suffix}"
+
+
+def image_paths(folder):
+    """image paths under folder, reusing the index from a previous scan as long
+    as none of the directories have been modified since"""
+    index_path = folder_cache_path(folder, ".pkl")
+
+    try:
+        with open(index_path, "rb") as f:
+            index = pickle.load(f)
+
+        dir_mtimes = index["dir_mtimes"]
+        if all(os.stat(d).st_mtime_ns == m for d, m in dir_mtimes.items()):
+            return index["paths"]
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+        pass
+
+    paths, dir_mtimes = scan_folder(folder)
+
+    # written to a temporary file first, as every ddp rank may scan at once
+    try:
+        INDEX_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = index_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump({"paths": paths, "dir_mtimes": dir_mtimes}, f)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        pass
+
+    return paths
 
 
 class ImageDataset(Dataset):
-    def __init__(
-        self, folder, image_size, transparent=False, greyscale=False, aug_prob=0.0
-    ):
+    def __init__(self, folder, image_size, transparent=False, greyscale=False):
         super().__init__()
         self.folder = folder
         self.image_size = image_size
-        self.paths = [p for ext in EXTS for p in Path(f"{folder}").glob(f"**/*.{ext}")]
+        self.paths = image_paths(folder)
         assert len(self.paths) > 0, f"No images were found in {folder} for training"
 
         if transparent:
@@ -81,18 +156,16 @@ class ImageDataset(Dataset):
 
         convert_image_fn = partial(convert_image_to, pillow_mode)
 
+        self.num_channels = num_channels
+        self.convert_image_fn = convert_image_fn
+        self.expand_fn = expand_fn
+
         self.transform = transforms.Compose(
             [
                 transforms.Lambda(convert_image_fn),
                 transforms.Lambda(partial(resize_to_minimum_size, image_size)),
-                transforms.Resize(image_size),
-                random_apply(
-                    aug_prob,
-                    transforms.CenterCrop(image_size),
-                    transforms.RandomResizedCrop(
-                        image_size, scale=(0.5, 1.0), ratio=(0.98, 1.02)
-                    ),
-                ),
+                transforms.Resize(image_size, interpolation=InterpolationMode.BILINEAR),
+                transforms.CenterCrop(image_size),
                 transforms.ToTensor(),
                 transforms.Lambda(expand_fn),
             ]
@@ -105,3 +178,70 @@ class ImageDataset(Dataset):
         path = self.paths[index]
         img = Image.open(path)
         return self.transform(img)
+
+
+class CachedImageDataset(ImageDataset):
+    """decodes and center crops every image once into a uint8 memory-mapped
+    array, so later epochs only pay for reading raw pixels"""
+
+    def __init__(self, folder, image_size, transparent=False, greyscale=False):
+        super().__init__(
+            folder, image_size, transparent=transparent, greyscale=greyscale
+        )
+
+        cache_name = f"_cache_{image_size}_{self.num_channels}"
+        self.cache_path = folder_cache_path(folder, f"{cache_name}.npy")
+        self.cache_index_path = folder_cache_path(folder, f"{cache_name}_index.pkl")
+        self.cache = None
+
+        if not self.is_cache_valid():
+            self.build_cache()
+
+    def cache_index(self):
+        # mtime and size catch images edited or replaced under the same name
+        stats = [os.stat(path) for path in self.paths]
+        return {
+            "paths": list(map(str, self.paths)),
+            "stats": [(stat.st_mtime_ns, stat.st_size) for stat in stats],
+        }
+
+    def is_cache_valid(self):
+        if not self.cache_path.exists():
+            return False
+
+        try:
+            with open(self.cache_index_path, "rb") as f:
+                cached_index = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False
+
+        return cached_index == self.cache_index()
+
+    def build_cache(self):
+        INDEX_DIR.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_suffix(f".{os.getpid()}.tmp.npy")
+        first = self.transform(Image.open(self.paths[0]))
+        cache = np.lib.format.open_memmap(
+            str(tmp_path),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(len(self.paths), *first.shape),
+        )
+
+        for index, path in enumerate(self.paths):
+            tensor = first if index == 0 else self.transform(Image.open(path))
+            cache[index] = tensor.mul(255).round_().to(torch.uint8).numpy()
+
+        cache.flush()
+        del cache
+
+        tmp_path.replace(self.cache_path)
+        with open(self.cache_index_path, "wb") as f:
+            pickle.dump(self.cache_index(), f)
+
+    def __getitem__(self, index):
+        # opened lazily so each dataloader worker maps the file on its own
+        if self.cache is None:
+            self.cache = np.load(str(self.cache_path), mmap_mode="r")
+
+        return torch.from_numpy(np.array(self.cache[index])).float().div_(255)
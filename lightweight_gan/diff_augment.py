@@ -1,8 +1,43 @@
-from lightweight_gan.augmentations import AUGMENT_FNS
+from functools import lru_cache
 
+import torch
 
-def DiffAugment(x, types=[]):
-    for p in types:
-        for f in AUGMENT_FNS[p]:
+from lightweight_gan.augmentations import AUGMENT_FNS, FUSED_AUGMENT_FNS
+
+
+def augment_fns(types):
+    """resolve augmentation types to functions, using the fused version of two
+    consecutive types where one exists"""
+    fns = []
+    i = 0
+    while i < len(types):
+        pair = tuple(types[i : i + 2])
+        if pair in FUSED_AUGMENT_FNS:
+            fns.extend(FUSED_AUGMENT_FNS[pair])
+            i += 2
+        else:
+            fns.extend(AUGMENT_FNS[types[i]])
+            i += 1
+    return fns
+
+
+@lru_cache(maxsize=16)
+def build_diff_augment(types):
+    """the augmentation types are fixed for a whole training run, so resolve
+    them once into a straight-line function"""
+    fns = tuple(augment_fns(types))
+
+    def diff_augment(x):
+        for f in fns:
             x = f(x)
-    return x.contiguous()
+
+        # elementwise augmentations keep a channels last batch dense, leave it be
+        if x.is_contiguous(memory_format=torch.channels_last):
+            return x
+        return x.contiguous()
+
+    return diff_augment
+
+
+def DiffAugment(x, types=[]):
+    return build_diff_augment(tuple(types))(x)
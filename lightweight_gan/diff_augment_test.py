@@ -37,7 +37,7 @@ def DiffAugmentTest(
                 tmp_file_name = str(i) + ext
                 copyfile(file, os.path.join(directory, tmp_file_name))
 
-            dataset = ImageDataset(directory, image_size, aug_prob=0)
+            dataset = ImageDataset(directory, image_size)
             dataloader = DataLoader(dataset, batch_size=batch_size)
 
             image_batch = next(iter(dataloader)).cuda(rank)
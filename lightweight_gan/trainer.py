@@ -7,7 +7,9 @@ from pathlib import Path
 from random import random
 from shutil import rmtree
 
+import PIL
 import torch
+import torch.distributed as dist
 import torchvision
 import tqdm
 from PIL import Image
@@ -19,7 +21,8 @@ from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 from torchvision import transforms
 
-from lightweight_gan.dataset import ImageDataset
+from lightweight_gan.augmentations import random_resized_crop
+from lightweight_gan.dataset import CachedImageDataset, ImageDataset, pil_backend
 from lightweight_gan.exceptions import NanException
 from lightweight_gan.lightweight_gan import LightweightGAN
 from lightweight_gan.loss_fns import dual_contrastive_loss, gen_hinge_loss, hinge_loss
@@ -43,6 +46,9 @@ from lightweight_gan.version import __version__
 
 NUM_CORES = multiprocessing.cpu_count()
 
+# more workers than this per process mostly adds contention
+MAX_DEFAULT_WORKERS = 4
+
 
 def gradient_accumulate_contexts(gradient_accumulate_every, is_ddp, ddps):
     if is_ddp:
@@ -102,6 +108,10 @@ class Trainer:
         aim_repo=None,
         aim_run_hash=None,
         load_strict=True,
+        pin_memory=True,
+        cache_dataset=False,
+        channels_last=False,
+        cuda_graph=False,
         *args,
         **kwargs,
     ):
@@ -194,7 +204,21 @@ class Trainer:
 
         self.load_strict = load_strict
 
+        self.pin_memory = pin_memory
+        self.cache_dataset = cache_dataset
+        self.channels_last = channels_last
+        self.cuda_graph = cuda_graph
+
         self.amp = amp
+
+        has_tensor_cores = (
+            torch.cuda.is_available() and torch.cuda.get_device_capability(rank)[0] >= 7
+        )
+        if self.amp and not has_tensor_cores:
+            print(
+                "mixed precision needs tensor cores (volta or newer) to speed up training"
+            )
+
         self.G_scaler = GradScaler(enabled=self.amp)
         self.D_scaler = GradScaler(enabled=self.amp)
 
@@ -218,6 +242,14 @@ class Trainer:
     def image_extension(self):
         return "jpg" if not self.transparent else "png"
 
+    @property
+    def memory_format(self):
+        # nhwc only pays off for rgb images
+        use_channels_last = self.channels_last and not (
+            self.transparent or self.greyscale
+        )
+        return torch.channels_last if use_channels_last else torch.contiguous_format
+
     @property
     def checkpoint_num(self):
         return floor(self.steps // self.save_every)
@@ -238,8 +270,6 @@ class Trainer:
         # switching from multi-gpu back to single gpu
 
         if self.syncbatchnorm and not self.is_ddp:
-            import torch.distributed as dist
-
             os.environ["MASTER_ADDR"] = "localhost"
             os.environ["MASTER_PORT"] = "12355"
             dist.init_process_group("nccl", rank=0, world_size=1)
@@ -263,11 +293,16 @@ class Trainer:
             **kwargs,
         )
 
+        if self.memory_format == torch.channels_last:
+            self.GAN.to(memory_format=self.memory_format)
+
         if self.is_ddp:
             ddp_kwargs = {
                 "device_ids": [self.rank],
                 "output_device": self.rank,
                 "find_unused_parameters": True,
+                "bucket_cap_mb": 50,
+                "gradient_as_bucket_view": True,
             }
 
             self.G_ddp = DDP(self.GAN.G, **ddp_kwargs)
@@ -312,14 +347,18 @@ class Trainer:
 
     def set_data_src(self, folder):
         """load dataset and prep for training"""
-        num_workers = default(self.num_workers, math.ceil(NUM_CORES / self.world_size))
-        self.dataset = ImageDataset(
+        num_workers = default(
+            self.num_workers,
+            min(math.ceil(NUM_CORES / self.world_size), MAX_DEFAULT_WORKERS),
+        )
+        dataset_class = CachedImageDataset if self.cache_dataset else ImageDataset
+        self.dataset = dataset_class(
             folder,
             self.image_size,
             transparent=self.transparent,
             greyscale=self.greyscale,
-            aug_prob=self.dataset_aug_prob,
         )
+
         sampler = (
             DistributedSampler(
                 self.dataset, rank=self.rank, num_replicas=self.world_size, shuffle=True
@@ -327,6 +366,10 @@ class Trainer:
             if self.is_ddp
             else None
         )
+        # keep workers alive across epochs and prefetch ahead of the gpu
+        worker_kwargs = (
+            dict(persistent_workers=True, prefetch_factor=4) if num_workers > 0 else {}
+        )
         dataloader = DataLoader(
             self.dataset,
             num_workers=num_workers,
@@ -334,10 +377,14 @@ class Trainer:
             sampler=sampler,
             shuffle=not self.is_ddp,
             drop_last=True,
-            pin_memory=True,
+            pin_memory=self.pin_memory,
+            **worker_kwargs,
         )
         self.loader = cycle(dataloader)
 
+        if self.is_main:
+            print(f"decoding images with {pil_backend()} {PIL.__version__}")
+
         # auto set augmentation prob for user if dataset is detected to be low
         num_samples = len(self.dataset)
         if not exists(self.aug_prob) and num_samples < 1e5:
@@ -393,7 +440,11 @@ class Trainer:
             self.gradient_accumulate_every, self.is_ddp, ddps=[D_aug, G]
         ):
             latents = torch.randn(batch_size, latent_dim).cuda(self.rank)
-            image_batch = next(self.loader).cuda(self.rank)
+            image_batch = next(self.loader).cuda(
+                self.rank, non_blocking=self.pin_memory
+            )
+            image_batch = random_resized_crop(image_batch, prob=self.dataset_aug_prob)
+            image_batch = image_batch.contiguous(memory_format=self.memory_format)
             image_batch.requires_grad_()
 
             with amp_context():
@@ -487,7 +538,13 @@ class Trainer:
             latents = torch.randn(batch_size, latent_dim).cuda(self.rank)
 
             if G_requires_calc_real:
-                image_batch = next(self.loader).cuda(self.rank)
+                image_batch = next(self.loader).cuda(
+                    self.rank, non_blocking=self.pin_memory
+                )
+                image_batch = random_resized_crop(
+                    image_batch, prob=self.dataset_aug_prob
+                )
+                image_batch = image_batch.contiguous(memory_format=self.memory_format)
                 image_batch.requires_grad_()
 
             with amp_context():
@@ -567,7 +624,18 @@ class Trainer:
 
         self.steps += 1
 
-    @torch.no_grad()
+    def backoff_loss_scale(self):
+        """shrink the amp loss scales after a NaN, so the retried step is less
+        likely to overflow again"""
+        for scaler in (self.G_scaler, self.D_scaler):
+            if not scaler.is_enabled():
+                continue
+
+            state = scaler.state_dict()
+            state["scale"] = state["scale"] * state["backoff_factor"]
+            scaler.load_state_dict(state)
+
+    @torch.inference_mode()
     def evaluate(self, num=0, num_image_tiles=4):
         """evaluate gan, generate and save images"""
         self.GAN.eval()
@@ -662,7 +730,7 @@ class Trainer:
             nrow=num_rows,
         )
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def generate(
         self, num=0, num_image_tiles=4, checkpoint=None, types=["default", "ema"]
     ):
@@ -699,7 +767,7 @@ class Trainer:
 
         return dir_full
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def show_progress(self, num_images=4, types=["default", "ema"]):
         """show progress of training"""
         checkpoints = self.get_checkpoints()
@@ -744,7 +812,7 @@ class Trainer:
                 )
                 torchvision.utils.save_image(generated_image, path, nrow=num_images)
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def calculate_fid(self, num_batches):
         "calc fid score"
         from pytorch_fid import fid_score
@@ -797,12 +865,14 @@ class Trainer:
             [str(real_path), str(fake_path)], 256, latents.device, 2048
         )
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def generate_(self, G, style, num_image_tiles=8):
-        generated_images = evaluate_in_chunks(self.batch_size, G, style)
+        generated_images = evaluate_in_chunks(
+            self.batch_size, G, style, use_cuda_graph=self.cuda_graph
+        )
         return generated_images.clamp_(0.0, 1.0)
 
-    @torch.no_grad()
+    @torch.inference_mode()
     def generate_interpolation(
         self, num=0, num_image_tiles=8, num_steps=100, save_frames=False
     ):
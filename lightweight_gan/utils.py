@@ -1,19 +1,26 @@
-import datetime
 import random
+import weakref
 from contextlib import ExitStack, contextmanager
+from datetime import datetime
 from functools import lru_cache
-from math import log2
 
 import numpy as np
 import torch
+from torch import nn
 
 from lightweight_gan.exceptions import NanException
 
 
-def set_seed(seed):
+def set_seed(seed, deterministic=False):
+    """seed all random number generators
+
+    deterministic cudnn kernels make runs reproducible but cost throughput,
+    otherwise cudnn benchmarks the convolutions for the fixed image size and
+    picks the fastest algorithm
+    """
     torch.manual_seed(seed)
-    torch.backends.cudnn.deterministic = True
-    torch.backends.cudnn.benchmark = False
+    torch.backends.cudnn.deterministic = deterministic
+    torch.backends.cudnn.benchmark = not deterministic
     np.random.seed(seed)
     random.seed(seed)
 
@@ -31,11 +38,11 @@ def cast_list(el):
 
 
 def current_iso_datetime():
-    return datetime.now().isoformat()
+    return datetime.now().isoformat(timespec="seconds")
 
 
 def is_power_of_two(val):
-    return log2(val).is_integer()
+    return type(val) is int and val > 0 and (val & (val - 1)) == 0
 
 
 def cycle(iterable):
@@ -65,6 +72,9 @@ def null_context():
 
 
 def combine_contexts(contexts):
+    # materialize so the combined context can be entered more than once
+    contexts = list(contexts)
+
     @contextmanager
     def multi_contexts():
         with ExitStack() as stack:
@@ -73,28 +83,91 @@ def combine_contexts(contexts):
     return multi_contexts
 
 
-def set_requires_grad(model, bool):
-    for p in model.parameters():
-        p.requires_grad = bool
+def set_requires_grad(model, requires_grad):
+    """accepts a module or an already collected list of its parameters"""
+    params = model.parameters() if isinstance(model, nn.Module) else model
+    for p in params:
+        p.requires_grad_(requires_grad)
+
+
+# one captured graph per model, dropped along with the model
+CUDA_GRAPHS = weakref.WeakKeyDictionary()
+
+
+def cuda_graph_key(model, args):
+    # parameters swapped out (EMA assigns new .data) or a train / eval switch
+    # both invalidate the graph
+    tensors = (*model.parameters(), *model.buffers())
+    return (
+        tuple((arg.shape, arg.dtype, arg.device) for arg in args),
+        model.training,
+        tuple(t.data_ptr() for t in tensors),
+    )
+
+
+def cuda_graph_for(model, args):
+    """returns the graph, static inputs and static output for this model and
+    chunk shape, capturing it only on first use"""
+    key = cuda_graph_key(model, args)
+    cached = CUDA_GRAPHS.get(model)
+    if exists(cached) and cached[0] == key:
+        return cached[1:]
+
+    static_args = [arg.clone() for arg in args]
 
+    # warm up on a side stream, so cudnn picks its kernels before capture
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        model(*static_args)
+    torch.cuda.current_stream().wait_stream(stream)
 
-def evaluate_in_chunks(max_batch_size, model, *args):
+    # thread local, so the dataloader pin memory thread can keep working
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph, capture_error_mode="thread_local"):
+        static_output = model(*static_args)
+
+    CUDA_GRAPHS[model] = (key, graph, static_args, static_output)
+    return graph, static_args, static_output
+
+
+def evaluate_in_chunks(max_batch_size, model, *args, use_cuda_graph=False):
+    """run model over args in chunks of max_batch_size
+
+    with use_cuda_graph, full size chunks replay a CUDA graph that is cached
+    per model and chunk shape across calls, the ragged last chunk runs eagerly.
+    must be called without grad, on cuda tensors
+    """
     split_args = list(zip(*list(map(lambda x: x.split(max_batch_size, dim=0), args))))
-    chunked_outputs = [model(*i) for i in split_args]
+
+    if use_cuda_graph and all(arg.is_cuda for arg in args):
+        chunked_outputs = []
+        for chunk in split_args:
+            if chunk[0].shape[0] != max_batch_size:
+                chunked_outputs.append(model(*chunk))
+                continue
+
+            graph, static_args, static_output = cuda_graph_for(model, chunk)
+            for static_arg, arg in zip(static_args, chunk):
+                static_arg.copy_(arg)
+
+            graph.replay()
+            chunked_outputs.append(static_output.clone())
+    else:
+        chunked_outputs = [model(*i) for i in split_args]
+
     if len(chunked_outputs) == 1:
         return chunked_outputs[0]
     return torch.cat(chunked_outputs, dim=0)
 
 
 def slerp(val, low, high):
-    low_norm = low / torch.norm(low, dim=1, keepdim=True)
-    high_norm = high / torch.norm(high, dim=1, keepdim=True)
-    omega = torch.acos((low_norm * high_norm).sum(1))
+    cos_omega = (low * high).sum(1) / (low.norm(dim=1) * high.norm(dim=1))
+    omega = torch.acos(cos_omega)
     so = torch.sin(omega)
-    res = (torch.sin((1.0 - val) * omega) / so).unsqueeze(1) * low + (
-        torch.sin(val * omega) / so
-    ).unsqueeze(1) * high
-    return res
+    low_weight = (torch.sin((1.0 - val) * omega) / so).unsqueeze(1)
+    high_weight = (torch.sin(val * omega) / so).unsqueeze(1)
+    return torch.addcmul(low_weight * low, high_weight, high)
 
 
 @lru_cache(maxsize=10)
@@ -108,10 +181,7 @@ def det_randn(*args):
 
 def interpolate_between(a, b, *, num_samples, dim):
     assert num_samples > 2
-    samples = []
-    step_size = 0
-    for _ in range(num_samples):
-        sample = torch.lerp(a, b, step_size)
-        samples.append(sample)
-        step_size += 1 / (num_samples - 1)
-    return torch.stack(samples, dim=dim)
+    weights = torch.linspace(0.0, 1.0, num_samples, dtype=a.dtype, device=a.device)
+    weights = weights.view(-1, *((1,) * a.dim()))
+    samples = torch.lerp(a.unsqueeze(0), b.unsqueeze(0), weights)
+    return samples.movedim(0, dim)
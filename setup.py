@@ -30,7 +30,6 @@ setup(
     'kornia>=0.5.4',
     'numpy',
     'pillow',
-    'retry',
     'torch>=1.10',
     'torchvision',
     'tqdm'